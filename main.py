@@ -5,357 +5,558 @@ Optimized version with direct code extraction from URL
 """
 
 import asyncio
+import functools
+import hashlib
+import hmac
 import json
 import os
-import urllib.parse
+import re
+import secrets
 import time
+import urllib.parse
 from datetime import datetime
-from playwright.async_api import async_playwright
-from flask import Flask, request, jsonify
-import requests
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from quart import Quart, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+import orjson
+import httpx
 import logging
 
-# Configure logging to reduce Flask output
-logging.getLogger('werkzeug').setLevel(logging.ERROR)
+# Use uvloop's C event loop when available (hypercorn is started with --worker-class uvloop)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Configure logging to reduce server output
+logging.getLogger('hypercorn.access').setLevel(logging.ERROR)
 
 # --- Configuration ---
 CLIENT_ID = os.environ.get('CLIENT_ID', '8caf5ed3-088c-4fa5-b3a8-684e6f0d1616')
 SCOPES = os.environ.get('SCOPES', 'offline_access Mail.Read Mail.ReadWrite User.Read')
 REDIRECT_URI = os.environ.get('REDIRECT_URI', 'http://localhost:8080/callback')
+AUTHORITY = 'https://login.microsoftonline.com/common'
+AUTH_ENDPOINT = f'{AUTHORITY}/oauth2/v2.0/authorize'
+TOKEN_ENDPOINT = f'{AUTHORITY}/oauth2/v2.0/token'
+SCOPES_ENCODED = urllib.parse.quote(SCOPES)
+
+# Playwright timeouts in milliseconds. ACTION_TIMEOUT bounds any action without an explicit
+# timeout; SKIP_PROMPT_TIMEOUT is how long to look for the optional "Skip for now" prompt,
+# which is absent on most logins.
+ACTION_TIMEOUT = int(os.environ.get('PLAYWRIGHT_ACTION_TIMEOUT', '8000'))
+SKIP_PROMPT_TIMEOUT = int(os.environ.get('SKIP_PROMPT_TIMEOUT', '1500'))
+# Seconds a successful token response is served from the in-process cache (capped by expires_in)
+TOKEN_CACHE_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', '3600'))
+# Overall limit in seconds for one browser login, including the wait for a free context
+AUTOMATION_BUDGET = int(os.environ.get('AUTOMATION_BUDGET', '45'))
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for request parsing and jsonify."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Initialize Quart (async Flask API, served by hypercorn on a single event loop)
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+# Per-step progress logs only in debug runs; production defaults to warnings and errors
+app.logger.setLevel(logging.INFO if os.environ.get('DEBUG') else logging.WARNING)
+
+# --- Shared browser ---
+# Chromium is launched once per process and reused; each login gets its own context.
+BROWSER_ARGS = [
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-web-security',
+    '--disable-features=VizDisplayCompositor',
+    # Subsystems a headless, short-lived login session never uses
+    '--disable-background-networking',
+    '--disable-background-timer-throttling',
+    '--disable-breakpad',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-extensions',
+    '--disable-renderer-backgrounding',
+    '--disable-sync',
+    '--disable-translate',
+    '--hide-scrollbars',
+    '--mute-audio',
+    '--no-default-browser-check',
+    '--no-first-run',
+    '--no-zygote',
+    '--disable-blink-features=AutomationControlled'
+]
+# Cloud Run has no GPU; set CHROMIUM_DISABLE_GPU=0 to keep it where one is available
+if os.environ.get('CHROMIUM_DISABLE_GPU', '1') == '1':
+    BROWSER_ARGS.append('--disable-gpu')
+CONTEXT_OPTIONS = {
+    'viewport': {'width': 1280, 'height': 720},
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+}
+
+# Sub-resources that play no part in the OAuth redirect chain
+BLOCKED_RESOURCE_TYPES = {'image', 'media', 'font'}
+BLOCKED_URL_MARKERS = ('telemetry', 'browser.events.data.microsoft.com')
+
+# Number of browser contexts per instance: bounds concurrent logins and peak browser memory
+# At least 1: asyncio.Queue(maxsize=0) is unbounded and would hold no slots at all
+CONTEXT_POOL_SIZE = max(1, int(os.environ.get('CONTEXT_POOL_SIZE', '4')))
+
+_playwright = None
+_browser = None
+_browser_lock = asyncio.Lock()
+# One slot per context; a slot holds a ready context, or None when it must be created on acquire
+_context_pool = asyncio.Queue(maxsize=CONTEXT_POOL_SIZE)
+_background_tasks = set()
+# Set in after_serving so background recycling cannot relaunch the browser after shutdown
+_shutting_down = False
+
+async def get_browser():
+    """Return the shared Chromium instance, launching it on first use."""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _shutting_down:
+            raise RuntimeError("Server is shutting down")
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(headless=True, args=BROWSER_ARGS)
+            app.logger.info("Shared browser launched.")
+        return _browser
+
+async def block_heavy_resources(route):
+    """Route handler aborting images, fonts, media and telemetry beacons."""
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or any(marker in req.url for marker in BLOCKED_URL_MARKERS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _create_context():
+    """Create a browser context with the standard options and resource blocking."""
+    browser = await get_browser()
+    context = await browser.new_context(**CONTEXT_OPTIONS)
+    await context.route('**/*', block_heavy_resources)
+    return context
+
+async def _try_create_context():
+    """Create a context, or return None if the browser is currently unavailable."""
+    try:
+        return await _create_context()
+    except Exception as e:
+        app.logger.warning("⚠️ Unable to pre-warm browser context: %s", e)
+        return None
+
+async def warm_context_pool():
+    """Fill every pool slot with a ready context, discarding slots left over from a previous run."""
+    while not _context_pool.empty():
+        _context_pool.get_nowait()
+    contexts = await asyncio.gather(*(_try_create_context() for _ in range(CONTEXT_POOL_SIZE)))
+    for context in contexts:
+        _context_pool.put_nowait(context)
+
+async def acquire_context():
+    """Wait for a free pool slot and return its context, creating one if the slot is empty."""
+    context = await _context_pool.get()
+    if context is not None and context.browser is not None and context.browser.is_connected():
+        return context
+    try:
+        return await _create_context()
+    except BaseException:
+        # Includes cancellation: the slot must go back to the pool either way
+        _context_pool.put_nowait(None)
+        raise
+
+async def _recycle_context(context):
+    """Close a used context and refill its slot with a fresh one."""
+    try:
+        await context.close()
+    except Exception as e:
+        app.logger.warning("⚠️ Error closing browser context: %s", e)
+    if _shutting_down:
+        return
+    _context_pool.put_nowait(await _try_create_context())
+
+def release_context(context):
+    """Return a context's slot to the pool, replacing the context in the background.
+
+    Contexts are never handed to a second login: cookies can be cleared, but local
+    storage and HTTP cache from the previous account would survive.
+    """
+    task = asyncio.create_task(_recycle_context(context))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def close_browser():
+    """Shut down the shared browser and Playwright driver."""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is not None:
+            await _browser.close()
+            _browser = None
+        if _playwright is not None:
+            await _playwright.stop()
+            _playwright = None
+        app.logger.info("Shared browser closed.")
+
+# --- Token endpoint client ---
+# Shared so the TLS connection to login.microsoftonline.com stays alive across requests.
+# Connection failures are retried by the transport; HTTP errors are not, since an
+# authorization code can only be redeemed once.
+def create_token_client():
+    """Build the pooled HTTP/2 client used for token exchanges."""
+    return httpx.AsyncClient(
+        timeout=30,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+        )
+    )
+
+# --- Token cache ---
+# Repeat requests for the same credentials skip the browser login entirely. Entries are keyed
+# by an HMAC of client id, email and password under a per-process secret, so a hit needs the
+# right password and no credential is kept in memory.
+_TOKEN_CACHE_SECRET = secrets.token_bytes(32)
+_token_cache = {}
+
+def _token_cache_key(email, password):
+    """Derive the cache key for a set of credentials."""
+    message = '\0'.join((CLIENT_ID, email, password)).encode()
+    return hmac.new(_TOKEN_CACHE_SECRET, message, hashlib.sha256).digest()
+
+def get_cached_tokens(email, password):
+    """Return a cached token response with at least a minute of validity left, or None.
+
+    The returned copy reports in expires_in the seconds the access token actually has left.
+    """
+    entry = _token_cache.get(_token_cache_key(email, password))
+    now = time.monotonic()
+    if not entry or now >= entry[1] - 60:
+        return None
+    result, _, token_expiry = entry
+    return {**result, 'expires_in': int(token_expiry - now)}
+
+def cache_tokens(email, password, result):
+    """Store a successful token response and drop expired entries."""
+    now = time.monotonic()
+    for key in [key for key, (_, expiry, _) in _token_cache.items() if expiry <= now]:
+        del _token_cache[key]
+    token_expiry = now + int(result.get('expires_in') or TOKEN_CACHE_TTL)
+    cache_expiry = min(now + TOKEN_CACHE_TTL, token_expiry)
+    _token_cache[_token_cache_key(email, password)] = (result, cache_expiry, token_expiry)
+
+# --- Login page selectors ---
+# Alternatives are joined into one selector list so a single locator matches whichever variant
+# the page renders; "visible=true" skips hidden duplicates of the same control.
+EMAIL_SELECTOR = ('input[type="email"], #i0116, input[name="loginfmt"], '
+                  'input[placeholder*="email" i] >> visible=true')
+PASSWORD_SELECTOR = ('input[type="password"], #i0118, input[name="passwd"], input[name="Password"], '
+                     'input[placeholder*="password" i] >> visible=true')
+ACCEPT_SELECTOR = '#idSIButton9, input[type="submit"][value*="Accept"] >> visible=true'
+STAY_SIGNED_IN_SELECTOR = '#idSIButton9, input[type="submit"][value*="Yes"] >> visible=true'
+# "Skip for now" link variants
+SKIP_SELECTOR = ', '.join([
+    '#iShowSkip',
+    'a:has-text("Skip for now")',
+    'a[href="#"]:has-text("Skip")',
+    'a.secondary-text:has-text("Skip")',
+    'a:has-text("Salta per ora")',  # Versione italiana
+    '[class*="secondary"]:has-text("Skip")',
+    'button:has-text("Skip for now")',
+    'button:has-text("Skip")',
+    'a[id*="Skip"]',
+    'a[class*="skip"]'
+]) + ' >> visible=true'
+SKIP_TEXT = re.compile('skip', re.IGNORECASE)
+ACCEPT_BUTTON_NAME = re.compile('Accept|Allow|Accetta')
+YES_BUTTON_NAME = re.compile('Yes|Sì')
+
+# --- Page snapshot ---
+# Elements that may carry a login error message; the first match of each is reported
+ERROR_MESSAGE_SELECTORS = [
+    '#field-8__validationMessage',
+    '.fui-Field__validationMessage',
+    '[id*="validationMessage"]',
+    '[class*="validationMessage"]',
+    '[class*="error"]',
+    '.alert-error',
+    '.error-message'
+]
+PAGE_SNAPSHOT_JS = """
+(errorSelectors) => ({
+    url: location.href,
+    bodyText: document.body ? document.body.innerText : '',
+    errorTexts: errorSelectors
+        .map(selector => document.querySelector(selector))
+        .filter(element => element && element.innerText.trim())
+        .map(element => element.innerText)
+})
+"""
 
-# Initialize Flask
-app = Flask(__name__)
-app.logger.setLevel(logging.INFO)
+# --- Page text matchers ---
+def _phrase_pattern(phrases):
+    """Build one alternation over literal phrases"""
+    return '|'.join(re.escape(phrase) for phrase in phrases)
+
+# Error types returned by _check_account_status, in the original indicator order: consecutive
+# phrases of the same type share one pattern, and the first type whose pattern matches wins
+ACCOUNT_ERROR_PHRASES = [
+    ('ACCOUNT_LOCKED', [
+        'account has been locked',
+        'account is locked',
+        'temporarily locked'
+    ]),
+    ('INVALID_CREDENTIALS', [
+        'incorrect username or password',
+        'sign-in name or password is incorrect',
+        'password is incorrect'
+    ]),
+    ('ACCOUNT_NOT_FOUND', [
+        'we couldn\'t find an account',
+        'account doesn\'t exist'
+    ]),
+    ('INVALID_CREDENTIALS', [
+        'invalid username or password'
+    ])
+]
+ACCOUNT_ERROR_RES = [
+    (error_type, re.compile(_phrase_pattern(phrases)))
+    for error_type, phrases in ACCOUNT_ERROR_PHRASES
+]
+PASSWORD_ERROR_RE = re.compile(_phrase_pattern([
+    'password is incorrect',
+    'incorrect password',
+    'wrong password',
+    'invalid password'
+]))
+CONSENT_PROMPT_RE = re.compile(_phrase_pattern([
+    'permissions requested', 'consent', 'accept', 'allow',
+    'wants to access', 'autorizzazioni', 'consenso'
+]))
+STAY_SIGNED_IN_PROMPT_RE = re.compile(_phrase_pattern([
+    'stay signed', 'rimani connesso'
+]))
+
+@functools.lru_cache(maxsize=8)
+def build_auth_url(redirect_uri):
+    """Build the authorization URL; cached because an instance only ever sees a few redirect URIs."""
+    return (f'{AUTH_ENDPOINT}?client_id={CLIENT_ID}&response_type=code'
+            f'&redirect_uri={urllib.parse.quote(redirect_uri)}'
+            f'&response_mode=query&scope={SCOPES_ENCODED}&state=12345')
 
 class MicrosoftOAuthAutomator:
-    def __init__(self, client_id, redirect_uri, scopes):
-        self.client_id = client_id
+    def __init__(self, redirect_uri):
         self.redirect_uri = redirect_uri
-        self.scopes = scopes
-        self.authority = 'https://login.microsoftonline.com/common'
-        self.auth_endpoint = f'{self.authority}/oauth2/v2.0/authorize'
-        self.token_endpoint = f'{self.authority}/oauth2/v2.0/token'
         self.auth_code = None
         self.error = None
+        self._code_event = asyncio.Event()
+        self._auth_url = build_auth_url(redirect_uri)
 
     def generate_auth_url(self):
-        """Generate Microsoft authorization URL."""
-        return (f'{self.auth_endpoint}?client_id={self.client_id}&response_type=code'
-                f'&redirect_uri={urllib.parse.quote(self.redirect_uri)}'
-                f'&response_mode=query&scope={urllib.parse.quote(self.scopes)}&state=12345')
+        """Return the Microsoft authorization URL."""
+        return self._auth_url
 
     async def automate_login(self, email, password):
         """Automate login process and capture authorization code."""
-        async with async_playwright() as p:
-            app.logger.info("Starting Microsoft login automation in headless mode...")
-            
-            browser = await p.chromium.launch(
-                headless=True,
-                args=[
-                    '--no-sandbox', 
-                    '--disable-dev-shm-usage',
-                    '--disable-web-security',
-                    '--disable-features=VizDisplayCompositor'
-                ]
-            )
-            
-            context = await browser.new_context(
-                viewport={'width': 1280, 'height': 720},
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-            )
-            
+        app.logger.info("Starting Microsoft login automation in headless mode...")
+        
+        context = await acquire_context()
+        
+        try:
+            context.on('request', self._on_request)
             page = await context.new_page()
+            page.set_default_timeout(ACTION_TIMEOUT)
 
-            try:
-                auth_url = self.generate_auth_url()
-                app.logger.info("Navigating to Microsoft login...")
-                await page.goto(auth_url, wait_until='domcontentloaded')
-                
-                await page.wait_for_load_state('domcontentloaded')
-                await page.wait_for_timeout(2000)
+            auth_url = self.generate_auth_url()
+            app.logger.info("Navigating to Microsoft login...")
+            # The email field wait below is the real readiness barrier
+            await page.goto(auth_url, wait_until='commit')
 
-                # Step 1: Email
-                await self._handle_email_input(page, email)
-                
-                # Step 2: Password
-                await self._handle_password_input(page, password)
-                
-                # Step 3: Check account status (moved after password input)
-                account_status = await self._check_account_status(page)
-                if account_status != "OK":
-                    self.error = f"Account error: {account_status}"
-                    return
-                
-                # Step 4: Additional prompts
-                await self._handle_additional_prompts(page)
-                
-                # Step 5: Extract code with direct URL check
-                await self._extract_auth_code(page)
+            # Step 1: Email
+            await self._handle_email_input(page, email)
+            
+            # Step 2: Password
+            await self._handle_password_input(page, password)
+            
+            # Step 3: Check account status (moved after password input)
+            account_status = await self._check_account_status(page)
+            if account_status != "OK":
+                self.error = f"Account error: {account_status}"
+                return
+            
+            # Step 4: Additional prompts
+            await self._handle_additional_prompts(page)
+            
+            # Step 5: Extract code with direct URL check
+            await self._extract_auth_code(page)
 
-            except Exception as e:
-                app.logger.error(f"Error during Playwright automation: {e}")
-                self.error = f"Automation error: {str(e)}"
-            finally:
-                await browser.close()
-                app.logger.info("Browser closed.")
+        except Exception as e:
+            app.logger.error("Error during Playwright automation: %s", e)
+            self.error = f"Automation error: {str(e)}"
+        finally:
+            release_context(context)
+            app.logger.info("Browser context released.")
+
+    def _on_request(self, req):
+        """Capture the authorization code as soon as the callback navigation is issued"""
+        url = req.url
+        # Exact redirect URI prefix: the encoded redirect_uri echoed in other URLs also contains "/callback"
+        if not url.startswith(self.redirect_uri + '?') or not req.is_navigation_request():
+            return
+        # Main frame only, as an iframe document load can also be a navigation request
+        if req.frame.parent_frame is not None:
+            return
+        
+        app.logger.info("🎯 Found callback URL: %s", url)
+        # Only the code is needed: scan the raw query instead of building the full parse_qs dict
+        query = url.partition('?')[2].partition('#')[0]
+        code = next((value for key, value in urllib.parse.parse_qsl(query) if key == 'code'), None)
+        
+        if code:
+            self.auth_code = code
+            app.logger.info("✅ Code extracted successfully: %s...", code[:50])
+            self._code_event.set()
+        else:
+            app.logger.warning("Code not found in URL parameters")
 
     async def _extract_auth_code(self, page):
-        """Extract authorization code by checking page URL"""
+        """Wait for the request listener to deliver the authorization code"""
         app.logger.info("Starting authorization code extraction...")
         
-        timeout = 30
-        start_time = time.time()
-        
-        while not self.auth_code and (time.time() - start_time) < timeout:
-            try:
-                current_url = page.url
-                app.logger.info(f"Current URL: {current_url}")
-                
-                # Check if we're at callback with code
-                if '/callback' in current_url and 'code=' in current_url:
-                    app.logger.info(f"🎯 Found callback URL: {current_url}")
-                    
-                    # Extract code
-                    parsed_url = urllib.parse.urlparse(current_url)
-                    query_params = urllib.parse.parse_qs(parsed_url.query)
-                    code = query_params.get('code', [None])[0]
-                    
-                    if code:
-                        self.auth_code = code
-                        app.logger.info(f"✅ Code extracted successfully: {code[:50]}...")
-                        break
-                    else:
-                        app.logger.warning("Code not found in URL parameters")
-                
-                # Wait before next check
-                await asyncio.sleep(0.5)
-                
-            except Exception as e:
-                app.logger.error(f"Error during code extraction: {e}")
-                await asyncio.sleep(1)
-        
-        if not self.auth_code:
-            # Last desperate attempt
-            try:
-                final_url = page.url
-                app.logger.info(f"🔄 Last attempt with URL: {final_url}")
-                
-                if 'code=' in final_url:
-                    # Extract manually
-                    import re
-                    code_match = re.search(r'code=([^&]+)', final_url)
-                    if code_match:
-                        self.auth_code = code_match.group(1)
-                        app.logger.info(f"✅ Code extracted with regex: {self.auth_code[:50]}...")
-                    
-            except Exception as e:
-                app.logger.error(f"Error in final attempt: {e}")
-        
-        if not self.auth_code:
+        try:
+            await asyncio.wait_for(self._code_event.wait(), timeout=15)
+        except asyncio.TimeoutError:
             self.error = "Unable to extract authorization code"
-            app.logger.error("❌ Code extraction failed completely")
-        else:
-            app.logger.info("🎉 Code extraction completed successfully")
+            app.logger.error("❌ Callback not reached, last URL: %s", page.url)
+            return
+        
+        app.logger.info("🎉 Code extraction completed successfully")
+
+    async def _wait_for_navigation(self, page, previous_url, timeout=5000):
+        """Wait until the page has left previous_url instead of sleeping a fixed time"""
+        try:
+            await page.wait_for_url(lambda url: url != previous_url, timeout=timeout, wait_until='domcontentloaded')
+            return True
+        except PlaywrightTimeoutError:
+            app.logger.info("No navigation away from %s within %sms", previous_url, timeout)
+            return False
+
+    async def _is_actionable(self, locator):
+        """Check visibility and enabled state concurrently instead of in two round trips"""
+        # is_enabled waits for the element to attach, so bound it: a missing control is just not actionable
+        is_visible, is_enabled = await asyncio.gather(
+            locator.is_visible(), locator.is_enabled(timeout=1000), return_exceptions=True
+        )
+        return is_visible is True and is_enabled is True
 
     async def _handle_email_input(self, page, email):
         """Handle email input"""
         app.logger.info("📧 Email input...")
         
-        await page.wait_for_load_state('domcontentloaded')
-        await page.wait_for_timeout(2000)
-        
-        email_selectors = [
-            'input[type="email"]',
-            '#i0116',
-            'input[name="loginfmt"]',
-            'input[placeholder*="email" i]',
-            'input[placeholder*="Email" i]'
-        ]
-        
-        email_filled = False
-        for selector in email_selectors:
-            try:
-                await page.wait_for_selector(selector, timeout=3000, state='visible')
-                
-                element = await page.query_selector(selector)
-                if element:
-                    is_visible = await element.is_visible()
-                    is_enabled = await element.is_enabled()
-                    
-                    if is_visible and is_enabled:
-                        await page.fill(selector, '')
-                        await page.fill(selector, email)
-                        await page.wait_for_timeout(500)
-                        
-                        app.logger.info(f"✅ Email entered with selector: {selector}")
-                        email_filled = True
-                        break
-            except Exception as e:
-                app.logger.warning(f"⚠️ Email attempt failed with {selector}: {str(e)}")
-                continue
-        
-        if not email_filled:
+        # A single locator over every candidate resolves as soon as any of them is visible
+        email_input = page.locator(EMAIL_SELECTOR).first
+        try:
+            await email_input.wait_for(state='visible', timeout=10000)
+            await email_input.fill(email)
+            app.logger.info("✅ Email entered")
+        except Exception as e:
+            app.logger.warning("⚠️ Email input failed: %s", e)
             raise Exception("Unable to enter email")
         
-        # Click Next
-        next_selectors = [
-            '#idSIButton9',
-            'input[type="submit"]',
-            'button[type="submit"]',
-            'button:has-text("Next")',
-            'button:has-text("Avanti")'
-        ]
-        
-        next_clicked = False
-        for selector in next_selectors:
-            try:
-                element = await page.query_selector(selector)
-                if element:
-                    is_visible = await element.is_visible()
-                    is_enabled = await element.is_enabled()
-                    
-                    if is_visible and is_enabled:
-                        await page.click(selector)
-                        app.logger.info(f"✅ Clicked 'Next' with selector: {selector}")
-                        await page.wait_for_timeout(2000)
-                        next_clicked = True
-                        break
-            except Exception as e:
-                app.logger.warning(f"⚠️ Next attempt failed with {selector}: {str(e)}")
-                continue
-        
-        if not next_clicked:
-            try:
-                await page.keyboard.press('Enter')
-                app.logger.info("✅ Pressed Enter as alternative")
-                await page.wait_for_timeout(2000)
-            except:
-                raise Exception("Unable to proceed after email entry")
+        # Submit from the field itself instead of locating and clicking 'Next'
+        try:
+            await email_input.press('Enter')
+            app.logger.info("✅ Pressed Enter to submit email")
+        except Exception:
+            raise Exception("Unable to proceed after email entry")
 
     async def _handle_password_input(self, page, password):
         """Handle password input"""
         app.logger.info("🔐 Password input...")
         
-        await page.wait_for_load_state('domcontentloaded')
-        await page.wait_for_timeout(2000)
-        
-        password_selectors = [
-            'input[type="password"]',
-            '#i0118',
-            'input[name="passwd"]',
-            'input[name="Password"]',
-            'input[placeholder*="password" i]'
-        ]
-        
-        password_filled = False
-        for selector in password_selectors:
-            try:
-                await page.wait_for_selector(selector, timeout=8000, state='visible')
-                
-                element = await page.query_selector(selector)
-                if element:
-                    is_visible = await element.is_visible()
-                    is_enabled = await element.is_enabled()
-                    
-                    if is_visible and is_enabled:
-                        await page.fill(selector, '')
-                        await page.fill(selector, password)
-                        await page.wait_for_timeout(500)
-                        
-                        app.logger.info(f"✅ Password entered with selector: {selector}")
-                        password_filled = True
-                        break
-            except Exception as e:
-                app.logger.warning(f"⚠️ Password attempt failed with {selector}: {str(e)}")
-                continue
-        
-        if not password_filled:
+        password_input = page.locator(PASSWORD_SELECTOR).first
+        try:
+            await password_input.wait_for(state='visible', timeout=8000)
+            await password_input.fill(password)
+            app.logger.info("✅ Password entered")
+        except Exception as e:
+            app.logger.warning("⚠️ Password input failed: %s", e)
             raise Exception("Unable to enter password")
         
-        signin_selectors = [
-            '#idSIButton9',
-            'input[type="submit"]',
-            'button[type="submit"]',
-            'button:has-text("Sign in")',
-            'button:has-text("Accedi")'
-        ]
-        
-        signin_clicked = False
-        for selector in signin_selectors:
-            try:
-                element = await page.query_selector(selector)
-                if element:
-                    is_visible = await element.is_visible()
-                    is_enabled = await element.is_enabled()
-                    
-                    if is_visible and is_enabled:
-                        await page.click(selector)
-                        app.logger.info(f"✅ Clicked 'Sign in' with selector: {selector}")
-                        await page.wait_for_timeout(3000)
-                        signin_clicked = True
-                        break
-            except Exception as e:
-                app.logger.warning(f"⚠️ Sign in attempt failed with {selector}: {str(e)}")
-                continue
+        url_before_signin = page.url
+        try:
+            await password_input.press('Enter')
+            app.logger.info("✅ Pressed Enter to sign in")
+        except Exception:
+            raise Exception("Unable to perform login")
         
-        if not signin_clicked:
-            try:
-                await page.keyboard.press('Enter')
-                app.logger.info("✅ Pressed Enter for login")
-                await page.wait_for_timeout(3000)
-            except:
-                raise Exception("Unable to perform login")
+        await self._wait_for_navigation(page, url_before_signin)
         
         # NUOVA FUNZIONALITÀ: Controllo per "Skip for now" dopo il login
         await self._handle_skip_for_now(page)
 
+    async def _race(self, *waits):
+        """Run waits concurrently and cancel the others once the first finishes; returns the finished tasks"""
+        tasks = [asyncio.ensure_future(wait) for wait in waits]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Also runs when the race itself is cancelled, so no wait outlives it
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        for task in done:
+            # A timed-out wait is an expected outcome; retrieve it so it isn't reported as unhandled
+            task.exception()
+        return done
+
+    async def _wait_for_next_prompt(self, page, timeout):
+        """Wait until the stay-signed-in/consent button renders or the auth code arrives"""
+        await self._race(
+            page.locator(STAY_SIGNED_IN_SELECTOR).first.wait_for(state='visible', timeout=timeout),
+            self._code_event.wait()
+        )
+
+    async def _wait_for_skip_prompt(self, page, skip_locator):
+        """Race the 'Skip for now' prompt against the page that follows it; True if the prompt showed up"""
+        skip_wait = asyncio.ensure_future(skip_locator.wait_for(state='visible', timeout=SKIP_PROMPT_TIMEOUT))
+        done = await self._race(skip_wait, self._wait_for_next_prompt(page, SKIP_PROMPT_TIMEOUT))
+        
+        if skip_wait in done and skip_wait.exception() is None:
+            return True
+        # Another page won the race; make sure the prompt didn't render alongside it
+        try:
+            return await skip_locator.is_visible()
+        except Exception:
+            return False
+
     async def _handle_skip_for_now(self, page):
         """Handle 'Skip for now' link if it appears after password input"""
         app.logger.info("🔍 Checking for 'Skip for now' option...")
         
-        await page.wait_for_load_state('domcontentloaded')
-        await page.wait_for_timeout(2000)
-        
         try:
-            # Selettori per il link "Skip for now"
-            skip_selectors = [
-                '#iShowSkip',
-                'a:has-text("Skip for now")',
-                'a[href="#"]:has-text("Skip")',
-                'a.secondary-text:has-text("Skip")',
-                'a:has-text("Salta per ora")',  # Versione italiana
-                '[class*="secondary"]:has-text("Skip")',
-                'button:has-text("Skip for now")',
-                'button:has-text("Skip")',
-                'a[id*="Skip"]',
-                'a[class*="skip"]'
-            ]
-            
             skip_clicked = False
             
-            for selector in skip_selectors:
+            # Un solo locator per tutte le varianti, limitato agli elementi il cui testo contiene "skip"
+            skip_locator = page.locator(SKIP_SELECTOR).filter(has_text=SKIP_TEXT).first
+            
+            # Aspetta una sola volta, in gara con la pagina successiva
+            if await self._wait_for_skip_prompt(page, skip_locator):
                 try:
-                    # Aspetta un po' per vedere se l'elemento appare
-                    await page.wait_for_selector(selector, timeout=3000, state='visible')
-                    
-                    element = await page.query_selector(selector)
-                    if element:
-                        is_visible = await element.is_visible()
-                        
-                        if is_visible:
-                            # Verifica che il testo contenga effettivamente "skip"
-                            element_text = await element.inner_text()
-                            if element_text and 'skip' in element_text.lower():
-                                await page.click(selector)
-                                app.logger.info(f"✅ Clicked 'Skip for now' with selector: {selector}")
-                                app.logger.info(f"   Text found: {element_text}")
-                                await page.wait_for_timeout(3000)
-                                skip_clicked = True
-                                break
-                            
+                    element_text = await skip_locator.inner_text()
+                    await skip_locator.click()
+                    app.logger.info("✅ Clicked 'Skip for now'")
+                    app.logger.info("   Text found: %s", element_text)
+                    await self._wait_for_next_prompt(page, 5000)
+                    skip_clicked = True
                 except Exception as e:
-                    app.logger.debug(f"Skip selector {selector} not found or not clickable: {str(e)}")
-                    continue
+                    app.logger.debug("Skip link not clickable: %s", e)
             
             if not skip_clicked:
                 # Controllo aggiuntivo cercando nel contenuto della pagina
@@ -381,9 +582,9 @@ class MicrosoftOAuthAutomator:
                                         text = await element.inner_text()
                                         if text and 'skip' in text.lower():
                                             await element.click()
-                                            app.logger.info(f"✅ Clicked 'Skip' via generic selector: {selector}")
-                                            app.logger.info(f"   Text: {text}")
-                                            await page.wait_for_timeout(3000)
+                                            app.logger.info("✅ Clicked 'Skip' via generic selector: %s", selector)
+                                            app.logger.info("   Text: %s", text)
+                                            await self._wait_for_next_prompt(page, 5000)
                                             skip_clicked = True
                                             break
                                 if skip_clicked:
@@ -394,193 +595,131 @@ class MicrosoftOAuthAutomator:
                         app.logger.info("✅ No 'Skip for now' option detected")
                         
                 except Exception as e:
-                    app.logger.debug(f"Error checking page content for skip option: {e}")
+                    app.logger.debug("Error checking page content for skip option: %s", e)
             
             if skip_clicked:
                 app.logger.info("🎯 'Skip for now' handled successfully")
             
         except Exception as e:
-            app.logger.warning(f"⚠️ Error during 'Skip for now' handling: {e}")
+            app.logger.warning("⚠️ Error during 'Skip for now' handling: %s", e)
             # Non è un errore critico, proseguiamo comunque
         
         app.logger.info("✅ Skip for now check completed")
 
+    async def _snapshot(self, page):
+        """Read URL, body text and error messages in a single CDP round trip"""
+        return await page.evaluate(PAGE_SNAPSHOT_JS, ERROR_MESSAGE_SELECTORS)
+
     async def _check_account_status(self, page):
         """Check for login errors - improved version"""
         app.logger.info("🔍 Checking account status...")
         
-        # Wait longer for any error messages to appear
-        await page.wait_for_timeout(3000)
-        
         try:
-            # Check for password error message specifically
-            password_error_selectors = [
-                '#field-8__validationMessage',
-                '.fui-Field__validationMessage',
-                '[id*="validationMessage"]',
-                '[class*="validationMessage"]',
-                '[class*="error"]',
-                '.alert-error',
-                '.error-message'
-            ]
+            snapshot = await self._snapshot(page)
             
-            for selector in password_error_selectors:
-                try:
-                    error_element = await page.query_selector(selector)
-                    if error_element:
-                        error_text = await error_element.inner_text()
-                        if error_text and error_text.strip():
-                            error_text_lower = error_text.lower()
-                            app.logger.info(f"Found error element with text: {error_text}")
-                            
-                            # Check for password-specific errors
-                            if any(phrase in error_text_lower for phrase in [
-                                'password is incorrect',
-                                'that password is incorrect',
-                                'incorrect password',
-                                'wrong password',
-                                'invalid password'
-                            ]):
-                                app.logger.error(f"❌ Invalid password detected: {error_text}")
-                                return "INVALID_CREDENTIALS"
-                except Exception as e:
-                    app.logger.debug(f"Error checking selector {selector}: {e}")
-                    continue
+            # Check for password error message specifically
+            for error_text in snapshot['errorTexts']:
+                app.logger.info("Found error element with text: %s", error_text)
+                
+                # Check for password-specific errors
+                if PASSWORD_ERROR_RE.search(error_text.lower()):
+                    app.logger.error("❌ Invalid password detected: %s", error_text)
+                    return "INVALID_CREDENTIALS"
             
             # Check page content for general errors
-            page_content = await page.text_content('body')
+            page_content = snapshot['bodyText']
             if page_content:
                 page_content_lower = page_content.lower()
                 
-                error_indicators = [
-                    ('account has been locked', 'ACCOUNT_LOCKED'),
-                    ('account is locked', 'ACCOUNT_LOCKED'),
-                    ('temporarily locked', 'ACCOUNT_LOCKED'),
-                    ('incorrect username or password', 'INVALID_CREDENTIALS'),
-                    ('sign-in name or password is incorrect', 'INVALID_CREDENTIALS'),
-                    ('that password is incorrect', 'INVALID_CREDENTIALS'),
-                    ('password is incorrect', 'INVALID_CREDENTIALS'),
-                    ('we couldn\'t find an account', 'ACCOUNT_NOT_FOUND'),
-                    ('account doesn\'t exist', 'ACCOUNT_NOT_FOUND'),
-                    ('invalid username or password', 'INVALID_CREDENTIALS')
-                ]
-                
-                for indicator, error_type in error_indicators:
-                    if indicator in page_content_lower:
-                        app.logger.error(f"❌ Detected: {error_type}")
+                for error_type, error_re in ACCOUNT_ERROR_RES:
+                    if error_re.search(page_content_lower):
+                        app.logger.error("❌ Detected: %s", error_type)
                         return error_type
             
             # Check current URL for error indicators
-            current_url = page.url
+            current_url = snapshot['url']
             if 'error' in current_url.lower():
-                app.logger.warning(f"Error detected in URL: {current_url}")
+                app.logger.warning("Error detected in URL: %s", current_url)
                 if 'invalid_grant' in current_url.lower():
                     return "INVALID_CREDENTIALS"
             
             # If we're still on a login.live.com page after password entry, it's likely an error
             if 'login.live.com' in current_url and 'post.srf' in current_url:
-                # Wait a bit more to see if there's a redirect
-                await page.wait_for_timeout(3000)
+                # Give a pending redirect a chance to land; the page text was already checked above
+                await self._wait_for_navigation(page, current_url, timeout=3000)
                 final_url = page.url
                 
                 if 'login.live.com' in final_url and 'post.srf' in final_url:
-                    app.logger.warning("Still on login page after credentials - likely invalid password")
-                    # Check one more time for error messages
-                    final_content = await page.text_content('body')
-                    if final_content and 'password is incorrect' in final_content.lower():
-                        return "INVALID_CREDENTIALS"
                     # If we're stuck on the same login page, assume invalid credentials
+                    app.logger.warning("Still on login page after credentials - likely invalid password")
                     return "INVALID_CREDENTIALS"
             
             app.logger.info("✅ Account OK")
             return "OK"
             
         except Exception as e:
-            app.logger.warning(f"⚠️ Error checking account: {e}")
+            app.logger.warning("⚠️ Error checking account: %s", e)
             return "OK"
 
     async def _handle_additional_prompts(self, page):
         """Handle additional prompts"""
         app.logger.info("🔍 Handling additional prompts...")
         
-        await page.wait_for_load_state('domcontentloaded')
-        await page.wait_for_timeout(2000)
-        
         max_attempts = 3
         attempt = 0
         
         while attempt < max_attempts:
             try:
-                page_content = await page.text_content('body')
-                page_content_lower = page_content.lower()
                 current_url = page.url
+                app.logger.info("📍 Current URL: %s", current_url)
                 
-                app.logger.info(f"📍 Current URL: {current_url}")
-                
-                # If already at callback, exit
-                if '/callback' in current_url:
+                # If already at callback, exit before pulling the page text
+                if '/callback' in current_url or self._code_event.is_set():
                     app.logger.info("✅ Already at callback, skipping additional prompts")
                     break
                 
+                snapshot = await self._snapshot(page)
+                page_content_lower = snapshot['bodyText'].lower()
+                
                 # Handle consent
-                if any(keyword in page_content_lower for keyword in [
-                    'permissions requested', 'consent', 'accept', 'allow',
-                    'wants to access', 'autorizzazioni', 'consenso'
-                ]):
+                if CONSENT_PROMPT_RE.search(page_content_lower):
                     app.logger.info("📋 Consent prompt detected...")
                     
-                    accept_selectors = [
-                        '#idSIButton9',
-                        'button:has-text("Accept")',
-                        'button:has-text("Allow")',
-                        'button:has-text("Accetta")',
-                        'input[type="submit"][value*="Accept"]'
-                    ]
+                    accept_button = page.locator(ACCEPT_SELECTOR).or_(
+                        page.get_by_role('button', name=ACCEPT_BUTTON_NAME)
+                    ).first
                     
                     accepted = False
-                    for selector in accept_selectors:
-                        try:
-                            element = await page.query_selector(selector)
-                            if element and await element.is_visible() and await element.is_enabled():
-                                await page.click(selector)
-                                app.logger.info(f"✅ Accepted consent with: {selector}")
-                                await page.wait_for_timeout(3000)
-                                accepted = True
-                                break
-                        except Exception as e:
-                            app.logger.warning(f"⚠️ Consent attempt failed: {e}")
-                            continue
+                    try:
+                        if await self._is_actionable(accept_button):
+                            await accept_button.click()
+                            app.logger.info("✅ Accepted consent")
+                            await self._wait_for_navigation(page, current_url)
+                            accepted = True
+                    except Exception as e:
+                        app.logger.warning("⚠️ Consent attempt failed: %s", e)
                     
                     if accepted:
                         attempt += 1
                         continue
                 
                 # Handle "Stay signed in"
-                elif any(keyword in page_content_lower for keyword in [
-                    'stay signed in', 'rimani connesso', 'stay signed'
-                ]):
+                elif STAY_SIGNED_IN_PROMPT_RE.search(page_content_lower):
                     app.logger.info("🔄 'Stay signed in' prompt detected...")
                     
-                    yes_selectors = [
-                        '#idSIButton9',
-                        'button:has-text("Yes")',
-                        'button:has-text("Sì")',
-                        'input[type="submit"][value*="Yes"]'
-                    ]
+                    yes_button = page.locator(STAY_SIGNED_IN_SELECTOR).or_(
+                        page.get_by_role('button', name=YES_BUTTON_NAME)
+                    ).first
                     
                     accepted = False
-                    for selector in yes_selectors:
-                        try:
-                            element = await page.query_selector(selector)
-                            if element and await element.is_visible() and await element.is_enabled():
-                                await page.click(selector)
-                                app.logger.info(f"✅ Clicked 'Yes' with: {selector}")
-                                await page.wait_for_timeout(3000)
-                                accepted = True
-                                break
-                        except Exception as e:
-                            app.logger.warning(f"⚠️ Stay signed in attempt failed: {e}")
-                            continue
+                    try:
+                        if await self._is_actionable(yes_button):
+                            await yes_button.click()
+                            app.logger.info("✅ Clicked 'Yes'")
+                            await self._wait_for_navigation(page, current_url)
+                            accepted = True
+                    except Exception as e:
+                        app.logger.warning("⚠️ Stay signed in attempt failed: %s", e)
                     
                     if accepted:
                         attempt += 1
@@ -591,30 +730,30 @@ class MicrosoftOAuthAutomator:
                     break
                 
             except Exception as e:
-                app.logger.warning(f"⚠️ Error during prompt handling: {e}")
+                app.logger.warning("⚠️ Error during prompt handling: %s", e)
                 break
             
             attempt += 1
         
         app.logger.info("✅ Prompt handling completed")
 
-    def exchange_code_for_token(self):
+    async def exchange_code_for_token(self):
         """Exchange authorization code for tokens."""
         if self.error:
             return {"error": "AUTOMATION_FAILED", "message": self.error}
         if not self.auth_code:
             return {"error": "AUTH_CODE_MISSING", "message": "Unable to obtain authorization code."}
 
-        app.logger.info(f"🔄 Exchanging authorization code: {self.auth_code[:20]}...")
+        app.logger.info("🔄 Exchanging authorization code: %s...", self.auth_code[:20])
         data = {
-            'client_id': self.client_id,
-            'scope': self.scopes,
+            'client_id': CLIENT_ID,
+            'scope': SCOPES,
             'code': self.auth_code,
             'redirect_uri': self.redirect_uri,
             'grant_type': 'authorization_code'
         }
         try:
-            response = requests.post(self.token_endpoint, data=data, timeout=30)
+            response = await app.token_client.post(TOKEN_ENDPOINT, data=data)
             token_data = response.json()
 
             if 'refresh_token' in token_data:
@@ -628,59 +767,90 @@ class MicrosoftOAuthAutomator:
                     'obtained_at': datetime.now().isoformat()
                 }
             else:
-                app.logger.error(f"❌ Error during token exchange: {token_data}")
+                app.logger.error("❌ Error during token exchange: %s", token_data)
                 return {"error": "TOKEN_EXCHANGE_FAILED", "message": token_data}
         except Exception as e:
-            app.logger.error(f"❌ Error in token exchange request: {e}")
+            app.logger.error("❌ Error in token exchange request: %s", e)
             return {"error": "REQUEST_FAILED", "message": str(e)}
 
-# --- Flask Endpoints ---
+@app.before_serving
+async def startup():
+    """Launch the shared browser, pre-warm contexts and open the token client before accepting requests."""
+    global _shutting_down
+    _shutting_down = False
+    app.token_client = create_token_client()
+    await get_browser()
+    await warm_context_pool()
+
+@app.after_serving
+async def shutdown():
+    """Stop context recycling, then close the shared browser and token client on server shutdown."""
+    global _shutting_down
+    _shutting_down = True
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_browser()
+    await app.token_client.aclose()
+
+# --- Quart Endpoints ---
 
 @app.route('/', methods=['POST'])
-def get_refresh_token():
+async def get_refresh_token():
     """Main endpoint to obtain refresh token."""
     if not request.is_json:
         return jsonify({"error": "INVALID_REQUEST", "message": "Request must be in JSON format."}), 400
 
-    data = request.get_json()
+    data = await request.get_json()
     email = data.get('email')
     password = data.get('password')
 
     if not email or not password:
         return jsonify({"error": "MISSING_CREDENTIALS", "message": "Email and password are required."}), 400
 
-    app.logger.info(f"📧 Received request for email: {email}")
+    app.logger.info("📧 Received request for email: %s", email)
+
+    cached = get_cached_tokens(email, password)
+    if cached:
+        app.logger.info("⚡ Returning cached tokens")
+        return jsonify(cached), 200
 
     # Dynamic URL for Cloud Run
     service_url = request.headers.get("X-Forwarded-Proto", "http") + "://" + request.headers.get("Host", "localhost:8080")
     dynamic_redirect_uri = f"{service_url}/callback"
     
-    app.logger.info(f"🌐 Using dynamic redirect_uri: {dynamic_redirect_uri}")
+    app.logger.info("🌐 Using dynamic redirect_uri: %s", dynamic_redirect_uri)
 
-    automator = MicrosoftOAuthAutomator(CLIENT_ID, dynamic_redirect_uri, SCOPES)
+    automator = MicrosoftOAuthAutomator(dynamic_redirect_uri)
 
-    # Run automation
-    result = asyncio.run(automator.automate_login(email, password))
+    # Run automation within an overall budget so a stuck page cannot hold a context slot forever
+    try:
+        await asyncio.wait_for(automator.automate_login(email, password), timeout=AUTOMATION_BUDGET)
+    except asyncio.TimeoutError:
+        app.logger.error("❌ Automation exceeded %ss budget", AUTOMATION_BUDGET)
+        return jsonify({"error": "TIMEOUT", "message": "Automation exceeded time budget."}), 504
     
     # If there was an error in automation, return it
     if automator.error:
         return jsonify({"error": "AUTOMATION_FAILED", "message": automator.error}), 500
 
     # Exchange code for token
-    result = automator.exchange_code_for_token()
+    result = await automator.exchange_code_for_token()
 
     if 'error' in result:
         return jsonify(result), 500
     else:
+        cache_tokens(email, password, result)
         return jsonify(result), 200
 
 @app.route('/callback', methods=['GET'])
-def callback():
+async def callback():
     """Dummy callback endpoint."""
     return "Callback reached. You can close this window.", 200
 
 @app.route('/health', methods=['GET'])
-def health_check():
+async def health_check():
     """Health check endpoint for Cloud Run."""
     return jsonify({"status": "ok", "service": "microsoft-oauth-automator"}), 200
 